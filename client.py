@@ -1,154 +1,356 @@
 #!/usr/bin/env python3
 import argparse
 import asyncio
+import collections
+import functools
 import logging
+import socket
 import ssl
 from urllib.parse import urlencode, urlparse, urlunparse
-import websockets
+import aiohttp
 import constants
+import framing
 import watchdog as wd
 import sys
 
+try:
+    import uvloop
+except ImportError:
+    # No uvloop on e.g. windows/cygwin; fall back to the default loop
+    uvloop = None
+
 logger = logging.getLogger(__name__)
 
+LOG_LEVELS = {'debug': logging.DEBUG,
+              'info': logging.INFO,
+              'error': logging.ERROR,
+              'critical': logging.CRITICAL}
+
+
+def tune_socket(sock):
+    """Disable Nagle and widen the kernel buffers for bulk forwarding"""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, constants.SOCK_BUF_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, constants.SOCK_BUF_SIZE)
+
+
+def build_ssl_param(uri, certfile, client_cert):
+    if not uri.startswith('wss://'):
+        return dict()
+    ssl_context = ssl.create_default_context(cafile=certfile)
+    ssl_context.minimum_version = ssl.TLSVersion.TLSv1_2
+    if client_cert:
+        ssl_context.load_cert_chain(client_cert)
+    return {'ssl': ssl_context}
+
 
 class BaseServer:
+    __slots__ = ('client', 'done', '_buf', '_waiter')
+
     def __init__(self,
                  client,
                  f_write_to_transport,
                  f_conn_lost,
+                 session,
                  uri,
-                 certfile,
-                 client_cert,
+                 ws_param,
                  idle_timeout,
-                 compress,
-                 watchdog_server):
+                 compress):
+        # Single-producer single-consumer: a plain deque with a one-shot
+        # wakeup future is much lighter than asyncio.Queue
+        self._buf = collections.deque()
+        self._waiter = None
         self.client = client
         self.done = False
-        self.que = asyncio.Queue()
-        if uri.startswith('wss://'):
-            ssl_context = ssl.create_default_context(cafile=certfile)
-            ssl_context.minimum_version = ssl.TLSVersion.TLSv1_2
-            if client_cert:
-                ssl_context.load_cert_chain(client_cert)
-            ssl_param = {'ssl': ssl_context}
-        else:
-            ssl_param = dict()
-        asyncio.create_task(self.new_client(uri,
-                                            ssl_param,
+        asyncio.create_task(self.new_client(session,
+                                            uri,
+                                            ws_param,
                                             f_write_to_transport,
                                             f_conn_lost,
                                             idle_timeout,
-                                            compress,
-                                            watchdog_server))
+                                            compress))
 
     def data_received(self, data):
-        self.que.put_nowait(memoryview(data))
+        self._buf.append(memoryview(data))
+        self._wakeup_sender()
 
     def shutdown(self):
         self.done = True
-        self.que.put_nowait(None)
+        self._buf.append(None)
+        self._wakeup_sender()
+
+    def _wakeup_sender(self):
+        waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
 
     async def new_client(self,
+                         session,
                          uri,
-                         ssl_param,
+                         ws_param,
                          f_write_to_transport,
                          f_conn_lost,
                          idle_timeout,
-                         compress,
-                         watchdog_server):
+                         compress):
         tasks = []
         try:
-            async with websockets.connect(uri,
-                                          max_size=constants.WS_MAX_MSG_SIZE_COMP, max_queue=None,
-                                          compression=compress,
-                                          **ssl_param) as ws:
+            # aiohttp parses websocket frames in a C extension, which is
+            # considerably cheaper per frame than a pure-Python codec
+            async with session.ws_connect(uri,
+                                          max_msg_size=constants.WS_MAX_MSG_SIZE_COMP,
+                                          compress=15 if compress else 0,
+                                          **ws_param) as ws:
+                sock = ws.get_extra_info('socket')
+                if sock is not None:
+                    tune_socket(sock)
                 if idle_timeout:
-                    watchdog = wd.WatchdogClient(watchdog_server,
-                                                 idle_timeout,
-                                                 wd.IdleTimeout(f"Connection {self.client} has idled"))
-                    tasks.append(watchdog.start())
+                    deadline = wd.Deadline(idle_timeout,
+                                           wd.IdleTimeout(f"Connection {self.client} has idled"))
                 else:
-                    watchdog = None
-                tasks.append(asyncio.create_task(self.ws_data_sender(ws, watchdog)))
-                tasks.append(asyncio.create_task(self.ws_data_receiver(ws, f_write_to_transport, watchdog)))
-                done, _ = await asyncio.wait(tasks, return_when='FIRST_COMPLETED')
-                for i in done:
-                    exc = i.exception()
-                    if exc:
-                        raise exc
-        except (wd.IdleTimeout,
-                websockets.exceptions.ConnectionClosedOK) as e:
-            logger.info(repr(e))
+                    deadline = None
+                tasks.append(asyncio.create_task(self.ws_data_sender(ws, deadline)))
+                tasks.append(asyncio.create_task(self.ws_data_receiver(ws, f_write_to_transport, deadline)))
+                # Cheaper FIRST_COMPLETED: flip one future from done-callbacks
+                # instead of going through asyncio.wait's machinery
+                stop = asyncio.get_running_loop().create_future()
+                for t in tasks:
+                    t.add_done_callback(lambda f, s=stop: s.done() or s.set_result(f))
+                first = await stop
+                exc = first.exception()
+                if exc:
+                    raise exc
+        except wd.IdleTimeout as e:
+            logger.info('%r', e)
         except Exception as e:
-            logger.error(repr(e), exc_info=True)
+            logger.error('%r', e, exc_info=True)
         finally:
             for t in tasks:
                 t.cancel()
             if not self.done:
                 f_conn_lost(self.client)
 
-    async def ws_data_sender(self, ws, watchdog):
+    async def ws_data_sender(self, ws, deadline):
         M = constants.WS_MAX_MSG_SIZE
-        que = self.que
+        B = constants.WS_MAX_BATCH_SIZE
+        buf = self._buf
+        loop = asyncio.get_running_loop()
         while True:
-            if watchdog:
-                watchdog.reset()
-            data = await que.get()
-            if data is None:
-                que.task_done()
+            if deadline:
+                deadline.push()
+            while not buf:
+                self._waiter = loop.create_future()
+                try:
+                    await self._waiter
+                finally:
+                    self._waiter = None
+            # Coalesce everything already buffered into one message, up to
+            # the batch cap; record boundaries survive the merge
+            chunks = []
+            size = 0
+            eof = False
+            while buf:
+                data = buf.popleft()
+                if data is None:
+                    eof = True
+                    break
+                for i in range(0, len(data), M):
+                    chunk = data[i:i + M]
+                    chunks.append(chunk)
+                    size += framing.HDR_SIZE + len(chunk)
+                    if size >= B:
+                        rest = data[i + M:]
+                        if len(rest):
+                            buf.appendleft(rest)
+                        break
+                if size >= B:
+                    break
+            if chunks:
+                await ws.send_bytes(framing.encode(chunks))
+            if eof:
+                return
+
+    async def ws_data_receiver(self, ws, f_write_to_transport, deadline):
+        while True:
+            timeout = deadline.check() if deadline else None
+            try:
+                msg = await ws.receive(timeout=timeout)
+            except asyncio.TimeoutError:
+                # The sender may have pushed the deadline in the meantime;
+                # check() above decides whether the connection really idled
+                continue
+            if msg.type == aiohttp.WSMsgType.BINARY:
+                if deadline:
+                    deadline.push()
+                for data in framing.decode(msg.data):
+                    f_write_to_transport(data, self.client)
+            elif msg.type == aiohttp.WSMsgType.ERROR:
+                raise ws.exception()
+            elif msg.type in (aiohttp.WSMsgType.CLOSE,
+                              aiohttp.WSMsgType.CLOSING,
+                              aiohttp.WSMsgType.CLOSED):
                 return
-            for i in range(0, len(data), M):
-                await ws.send(data[i:i + M])
-            que.task_done()
 
-    async def ws_data_receiver(self, ws, f_write_to_transport, watchdog):
-        async for data in ws:
-            if watchdog:
-                watchdog.reset()
-            f_write_to_transport(data, self.client)
 
+class UdpServer(asyncio.DatagramProtocol):
+    """Multiplexes every UDP flow over one shared upstream connection.
 
-class UdpServer:
-    def __init__(self, uri, certfile, client_cert, idle_timeout, compress, watchdog_server):
-        self.base_servers = dict()
-        self.args = [uri, certfile, client_cert, idle_timeout, compress, watchdog_server]
+    Each source address gets a compact flow id; records on the wire are
+    flow id plus payload, so N concurrent flows cost one TLS handshake
+    and one pair of tunnel tasks instead of N.
+    """
+    __slots__ = ('flows', 'addrs', 'next_flow_id', 'mux', 'idle_timeout',
+                 'args', 'transport')
+
+    def __init__(self, session, uri, ws_param, idle_timeout, compress):
+        self.flows = dict()  # source addr -> (flow id, idle timer)
+        self.addrs = dict()  # flow id -> source addr
+        self.next_flow_id = 0
+        self.mux = None
+        self.idle_timeout = idle_timeout
+        self.args = [session, uri, ws_param, idle_timeout, compress]
+        super().__init__()
 
     def connection_made(self, transport):
         self.transport = transport
 
     def datagram_received(self, data, addr):
+        if self.mux is None:
+            logger.info('Opening shared upstream connection for UDP')
+            self.mux = BaseServer('udp-mux',
+                                  self.write_to_transport,
+                                  self.upstream_lost,
+                                  *self.args
+                                  )
+        # get() keeps the common known-flow case off the exception machinery
+        flow = self.flows.get(addr)
+        if flow is None:
+            if logger.isEnabledFor(logging.INFO):
+                logger.info('New UDP connection from %s', addr)
+            flow_id = self.next_flow_id
+            self.next_flow_id = (self.next_flow_id + 1) & 0xffffffff
+            # Evict idle flows so the maps do not grow without bound and a
+            # recycled flow id cannot alias a long-dead entry
+            if self.idle_timeout:
+                timer = wd.DeadlineTimer(self.idle_timeout,
+                                         functools.partial(self.evict_flow, addr))
+            else:
+                timer = None
+            flow = self.flows[addr] = (flow_id, timer)
+            self.addrs[flow_id] = addr
+        flow_id, timer = flow
+        if timer:
+            timer.push()
+        # Keep flow id and payload within one record so the prefix is
+        # never split away from its datagram
+        M = constants.WS_MAX_MSG_SIZE - framing.FLOW_HDR_SIZE
+        for i in range(0, len(data), M):
+            self.mux.data_received(framing.add_flow_id(flow_id, data[i:i + M]))
+
+    def write_to_transport(self, data, client):
+        flow_id, payload = framing.strip_flow_id(data)
+        addr = self.addrs.get(flow_id)
+        if addr is not None:
+            # Traffic in either direction keeps the flow alive
+            timer = self.flows[addr][1]
+            if timer:
+                timer.push()
+            self.transport.sendto(payload, addr)
+
+    def evict_flow(self, addr):
+        flow = self.flows.pop(addr, None)
+        if flow is not None:
+            if logger.isEnabledFor(logging.INFO):
+                logger.info('UDP connection from %s has idled', addr)
+            self.addrs.pop(flow[0], None)
+
+    def upstream_lost(self, client):
+        logger.info('Shared upstream connection for UDP is gone')
+        self.mux = None
+        for flow_id, timer in self.flows.values():
+            if timer:
+                timer.cancel()
+        self.flows.clear()
+        self.addrs.clear()
+
+
+class UdpSocketReader:
+    """Feeds UdpServer straight from a non-blocking socket.
+
+    recvfrom_into on a recycled bytearray avoids the per-datagram bytes
+    allocation a DatagramProtocol would make. UdpServer copies the
+    payload while tagging it with the flow id, so a buffer is free for
+    reuse as soon as datagram_received returns.
+    """
+    __slots__ = ('loop', 'sock', 'server', '_pool')
+
+    BUF_SIZE = 65536
+    POOL_SIZE = 8
+    # Datagrams drained per wakeup before yielding back to the loop, so a
+    # flood cannot starve the sender task that empties the mux buffer
+    MAX_READS = 64
+
+    def __init__(self, loop, sock, server):
+        self.loop = loop
+        self.sock = sock
+        self.server = server
+        self._pool = collections.deque()
+        # add_reader first: it raises NotImplementedError on loops without
+        # readers (windows proactor) and the caller then falls back
+        loop.add_reader(sock.fileno(), self._on_readable)
+        server.connection_made(self)
+
+    def sendto(self, data, addr):
         try:
-            base = self.base_servers[addr]
-        except KeyError:
-            logger.info(f'New UDP connection from {addr}')
-            base = self.base_servers[addr] = BaseServer(addr,
-                                                        self.transport.sendto,
-                                                        self.upstream_lost,
-                                                        *self.args
-                                                        )
-        base.data_received(data)
+            self.sock.sendto(data, addr)
+        except (BlockingIOError, InterruptedError):
+            pass  # UDP may drop under backpressure
 
-    def write_to_transport(self, data, addr):
-        self.transport.sendto(data, addr)
+    def close(self):
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
 
-    def upstream_lost(self, addr):
-        logger.info(f'Upstream connection for UDP client {addr} is gone')
-        self.base_servers.pop(addr)
+    def _on_readable(self):
+        pool = self._pool
+        sock = self.sock
+        server = self.server
+        for _ in range(self.MAX_READS):
+            buf = pool.popleft() if pool else bytearray(self.BUF_SIZE)
+            try:
+                n, addr = sock.recvfrom_into(buf)
+            except (BlockingIOError, InterruptedError):
+                pool.append(buf)
+                return
+            except OSError as e:
+                pool.append(buf)
+                logger.debug('UDP receive error: %r', e)
+                return
+            server.datagram_received(memoryview(buf)[:n], addr)
+            if len(pool) < self.POOL_SIZE:
+                pool.append(buf)
 
 
 class TcpServer(asyncio.Protocol):
-    def __init__(self, uri, certfile, client_cert, idle_timeout, compress, watchdog_server):
-        self.args = [uri, certfile, client_cert, idle_timeout, compress, watchdog_server]
+    __slots__ = ('args', 'peername', 'base', 'transport', 'loop',
+                 '_pending', '_flush_scheduled')
+
+    def __init__(self, session, uri, ws_param, idle_timeout, compress):
+        self.args = [session, uri, ws_param, idle_timeout, compress]
         self.peername = None
         self.base = None
         self.transport = None
+        self.loop = None
+        self._pending = bytearray()
+        self._flush_scheduled = False
         super().__init__()
 
     def connection_made(self, transport):
         peer_name = self.peername = transport.get_extra_info('peername')
-        logger.info(f'New TCP connection from {peer_name}')
+        logger.info('New TCP connection from %s', peer_name)
         self.transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            tune_socket(sock)
+        self.loop = asyncio.get_running_loop()
         self.base = BaseServer(peer_name,
                                self.write_to_transport,
                                self.upstream_lost,
@@ -156,10 +358,22 @@ class TcpServer(asyncio.Protocol):
                                )
 
     def data_received(self, data):
-        self.base.data_received(data)
+        # Merge chunks arriving within the same loop turn so the kernel's
+        # fragmentation of the stream does not dictate the enqueue count
+        self._pending += data
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.loop.call_soon(self._flush)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        if self._pending:
+            self.base.data_received(bytes(self._pending))
+            self._pending.clear()
 
     def connection_lost(self, exc):
-        logger.info(f'TCP connection from {self.peername} is down: {repr(exc)}')
+        logger.info('TCP connection from %s is down: %r', self.peername, exc)
+        self._flush()
         self.base.shutdown()
 
     def write_to_transport(self, data, addr):
@@ -180,6 +394,30 @@ def update_url_with_passwd(url, passwd):
     return urlunparse(url)
 
 
+def resolve_uri(uri, ws_param):
+    """Resolve the tunnel hostname once so reconnects skip DNS.
+
+    Returns the URI with the hostname replaced by its resolved address.
+    For wss:// the original hostname is kept for SNI and certificate
+    verification via server_hostname.
+    """
+    parsed = urlparse(uri)
+    secure = parsed.scheme == 'wss'
+    port = parsed.port or (443 if secure else 80)
+    try:
+        info = socket.getaddrinfo(parsed.hostname, port, type=socket.SOCK_STREAM)[0]
+    except socket.gaierror as e:
+        logger.warning('Could not pre-resolve %s: %r', parsed.hostname, e)
+        return uri
+    ip = info[4][0]
+    host = f'[{ip}]' if info[0] == socket.AF_INET6 else ip
+    if host == parsed.hostname:
+        return uri
+    if secure:
+        ws_param['server_hostname'] = parsed.hostname
+    return urlunparse(parsed._replace(netloc=f'{host}:{port}'))
+
+
 async def main(args):
     protocol, local_addr = args.listen.split('://', maxsplit=1)
     local_addr = local_addr.split(':', maxsplit=1)
@@ -191,32 +429,50 @@ async def main(args):
     if not uri.startswith('wss://'):
         logger.warning('Secure connection is disabled')
     compress = 'deflate' if args.enable_compress else None
+    # Build the TLS context once; CA and cert-chain parsing is too
+    # expensive to repeat per connection
+    ws_param = build_ssl_param(uri, args.ca_certs, args.client_cert)
+    uri = resolve_uri(uri, ws_param)
     loop = asyncio.get_running_loop()
-    watchdog_server = wd.WatchdogServer(loop).start()
-    if protocol == 'udp':
-        transport, _ = await loop.create_datagram_endpoint(lambda: UdpServer(uri,
-                                                                             args.ca_certs,
-                                                                             args.client_cert,
-                                                                             args.idle_timeout,
-                                                                             compress,
-                                                                             watchdog_server),
-                                                           local_addr=local_addr
-                                                           )
-        try:
-            await loop.create_future()  # Serve forever
-        finally:
-            transport.close()
-    else:
-        server = await loop.create_server(lambda: TcpServer(uri,
-                                                            args.ca_certs,
-                                                            args.client_cert,
-                                                            args.idle_timeout,
-                                                            compress,
-                                                            watchdog_server),
-                                          local_addr[0], local_addr[1]
-                                          )
-        async with server:
-            await server.serve_forever()
+    if sys.version_info >= (3, 12):
+        # Run new tasks synchronously up to their first suspension point
+        loop.set_task_factory(asyncio.eager_task_factory)
+    # The default connector caps at 100 concurrent connections, which
+    # would silently stall any tunneled connection past the hundredth
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        if protocol == 'udp':
+            info = socket.getaddrinfo(local_addr[0], local_addr[1],
+                                      type=socket.SOCK_DGRAM)[0]
+            sock = socket.socket(info[0], socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            sock.bind(info[4])
+            udp_server = UdpServer(session, uri, ws_param,
+                                   args.idle_timeout, compress)
+            try:
+                reader = UdpSocketReader(loop, sock, udp_server)
+            except NotImplementedError:
+                # The proactor loop (native windows without uvloop) has no
+                # add_reader; serve the same socket through a plain
+                # datagram endpoint instead
+                reader, _ = await loop.create_datagram_endpoint(
+                    lambda: udp_server, sock=sock)
+            try:
+                await loop.create_future()  # Serve forever
+            finally:
+                reader.close()
+        else:
+            server = await loop.create_server(lambda: TcpServer(session,
+                                                                uri,
+                                                                ws_param,
+                                                                args.idle_timeout,
+                                                                compress),
+                                              local_addr[0], local_addr[1]
+                                              )
+            for sock in server.sockets:
+                tune_socket(sock)
+            async with server:
+                await server.serve_forever()
 
 
 if __name__ == "__main__":
@@ -231,36 +487,32 @@ if __name__ == "__main__":
                         help="Server CA certificates in PEM format to verify against")
     parser.add_argument('-c', '--client-cert', type=str, metavar='client.pem',
                         help="Client certificate in PEM format with private key")
-    parser.add_argument('--enable-compress', type=bool, const=True, nargs='?', help='Compress data before sending')
+    parser.add_argument('--enable-compress', type=bool, const=True, nargs='?',
+                        help='Compress data before sending. Off by default: deflate only burns CPU '
+                             'when the tunneled payload is already encrypted or compressed')
     parser.add_argument('--log-file', type=str, metavar='FILE', help='Log to FILE')
-    parser.add_argument('--log-level', type=str, default="info", choices=['debug', 'info', 'error', 'critical'],
+    parser.add_argument('--log-level', type=str, default="info", choices=LOG_LEVELS,
                         help='Log level')
     args = parser.parse_args()
-    if args.log_level == 'debug':
-        log_level = logging.DEBUG
-    elif args.log_level == 'error':
-        log_level = logging.ERROR
-    elif args.log_level == 'critical':
-        log_level = logging.CRITICAL
-    else:
-        log_level = logging.INFO
+    log_level = LOG_LEVELS[args.log_level]
     logging_config_param = {'format': '%(levelname)s::%(asctime)s::%(filename)s:%(lineno)d::%(message)s',
                             'datefmt': '%Y-%m-%d %H:%M:%S'
                             }
     if args.log_file:
         logging_config_param['filename'] = args.log_file
+    # The log format uses none of these, so skip collecting them per record
+    logging.logMultiprocessing = False
+    logging.logProcesses = False
+    logging.logThreads = False
     logging.basicConfig(**logging_config_param)
     logger.setLevel(log_level)
     wd.logger.setLevel(log_level)
 
-    if sys.platform == 'cygwin':
-        # For windows, with no uvloop support
+    if uvloop is None:
         asyncio.run(main(args))
     elif sys.version_info >= (3, 11):
-        import uvloop
         with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
             runner.run(main(args))
     else:
-        import uvloop
         uvloop.install()
         asyncio.run(main(args))
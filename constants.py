@@ -1,3 +1,7 @@
 # Constants shared between client and server
-WS_MAX_MSG_SIZE = 4096
-WS_MAX_MSG_SIZE_COMP = 4114  # Maximum message size after compression due to overhead
+WS_MAX_MSG_SIZE = 4096  # Maximum payload size of a single tunneled record
+WS_MAX_BATCH_SIZE = 65536  # Senders stop batching records once a message reaches this size
+# Maximum websocket message size: a full batch may overshoot by one record
+# (header plus payload), plus compression overhead
+WS_MAX_MSG_SIZE_COMP = WS_MAX_BATCH_SIZE + 2 + WS_MAX_MSG_SIZE + 18
+SOCK_BUF_SIZE = 1 << 20  # SO_SNDBUF/SO_RCVBUF for tunneled TCP sockets
@@ -0,0 +1,62 @@
+"""Record framing shared between client and server.
+
+A websocket message carries one or more records, each a 16-bit big-endian
+payload length followed by that many bytes.  Length-prefixing every record
+keeps datagram boundaries intact when several of them are coalesced into a
+single message.
+
+Fully annotated so it can optionally be compiled to a C extension with
+mypyc (see misc/build_native.sh); the tunnel runs unchanged from source.
+"""
+import struct
+from typing import Iterable, Iterator, Tuple, Union
+
+Buf = Union[bytes, bytearray, memoryview]
+
+_HDR = struct.Struct('!H')
+HDR_SIZE: int = _HDR.size
+
+# UDP flows are multiplexed over one websocket connection; every UDP
+# record starts with a 32-bit big-endian flow id assigned by the client
+_FLOW = struct.Struct('!I')
+FLOW_HDR_SIZE: int = _FLOW.size
+
+
+def add_flow_id(flow_id: int, data: Buf) -> bytearray:
+    """Prefix a datagram with its flow id, copying the payload once."""
+    out = bytearray(FLOW_HDR_SIZE + len(data))
+    _FLOW.pack_into(out, 0, flow_id)
+    out[FLOW_HDR_SIZE:] = data
+    return out
+
+
+def strip_flow_id(data: Buf) -> Tuple[int, memoryview]:
+    """Split a record into (flow_id, payload memoryview)."""
+    view = memoryview(data)
+    flow_id: int = _FLOW.unpack_from(view, 0)[0]
+    return flow_id, view[FLOW_HDR_SIZE:]
+
+
+def encode(chunks: Iterable[Buf]) -> bytearray:
+    """Encode an iterable of chunks into a single websocket message.
+
+    Returns a bytearray to spare a final copy; callers must not hold on
+    to it past the send call.
+    """
+    out = bytearray()
+    for chunk in chunks:
+        out += _HDR.pack(len(chunk))
+        out += chunk
+    return out
+
+
+def decode(msg: Buf) -> Iterator[memoryview]:
+    """Yield the payload of every record as a zero-copy memoryview."""
+    view = memoryview(msg)
+    pos = 0
+    end = len(view)
+    while pos < end:
+        length: int = _HDR.unpack_from(view, pos)[0]
+        pos += HDR_SIZE
+        yield view[pos:pos + length]
+        pos += length
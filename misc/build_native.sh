@@ -0,0 +1,9 @@
+#!/bin/sh
+# Optionally compile the record codec to a C extension with mypyc.
+# framing.py sits on the per-packet hot path of both endpoints; the
+# compiled module is picked up automatically, and everything keeps
+# working from plain source if this script has never been run.
+set -e
+cd "$(dirname "$0")/.."
+pip install 'mypy[mypyc]'
+mypyc framing.py
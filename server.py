@@ -1,25 +1,56 @@
 #!/usr/bin/env python3
 import argparse
 import asyncio
+import collections
 import functools
 import hmac
 import json
 import logging
+import socket
 import ssl
 from collections import namedtuple
 from urllib.parse import urlparse, parse_qs
 import websockets
 import constants
+import framing
 import watchdog as wd
 import sys
 
+try:
+    import uvloop
+except ImportError:
+    # No uvloop on e.g. windows/cygwin; fall back to the default loop
+    uvloop = None
+
 logger = logging.getLogger(__name__)
 
+LOG_LEVELS = {'debug': logging.DEBUG,
+              'info': logging.INFO,
+              'error': logging.ERROR,
+              'critical': logging.CRITICAL}
 
-class UdpClient:
-    def __init__(self, que, peer_addr):
+
+def tune_socket(sock):
+    """Disable Nagle and widen the kernel buffers for bulk forwarding"""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, constants.SOCK_BUF_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, constants.SOCK_BUF_SIZE)
+
+
+class UdpMuxClient:
+    """Upstream endpoint of one multiplexed UDP flow.
+
+    Replies are tagged with the flow id before queuing; a single flow
+    going away must not tear down the shared websocket connection, so no
+    EOF sentinel is written.
+    """
+    __slots__ = ('que', 'peer_addr', 'flow_id', 'timer', 'transport')
+
+    def __init__(self, que, peer_addr, flow_id, timer):
         self.que = que
         self.peer_addr = peer_addr
+        self.flow_id = flow_id
+        self.timer = timer
         self.transport = None
 
     def connection_made(self, transport):
@@ -28,20 +59,24 @@ class UdpClient:
     def datagram_received(self, data, addr):
         if self.peer_addr != addr:
             return
-        self.que.put_nowait(memoryview(data))
+        if self.timer:
+            self.timer.push()
+        # Keep flow id and payload within one record so the prefix is
+        # never split away from its datagram
+        M = constants.WS_MAX_MSG_SIZE - framing.FLOW_HDR_SIZE
+        for i in range(0, len(data), M):
+            self.que.put_nowait(framing.add_flow_id(self.flow_id, data[i:i + M]))
 
     def error_received(self, exc):
-        logger.debug(f"UdpClient.error_received: {repr(exc)}")
+        logger.debug('UdpMuxClient.error_received: %r', exc)
 
     def connection_lost(self, exc):
-        logger.debug(f"UdpClient.connection_lost: {repr(exc)}")
-        self.write_eof_to_que()
-
-    def write_eof_to_que(self):
-        self.que.put_nowait(None)
+        logger.debug('UdpMuxClient.connection_lost: %r', exc)
 
 
 class TcpClient(asyncio.Protocol):
+    __slots__ = ('que', 'peer_addr', 'transport')
+
     def __init__(self, que, peer_addr):
         self.que = que
         self.peer_addr = peer_addr
@@ -49,37 +84,126 @@ class TcpClient(asyncio.Protocol):
 
     def connection_made(self, transport):
         self.transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            tune_socket(sock)
 
     def data_received(self, data):
         self.que.put_nowait(memoryview(data))
 
     def connection_lost(self, exc):
-        logger.debug(f"TcpClient.connection_lost: {repr(exc)}")
+        logger.debug('TcpClient.connection_lost: %r', exc)
         self.write_eof_to_que()
 
     def write_eof_to_que(self):
         self.que.put_nowait(None)
 
 
-async def ws_data_sender(ws, que, watchdog):
+async def ws_data_sender(ws, que, deadline):
     M = constants.WS_MAX_MSG_SIZE
+    B = constants.WS_MAX_BATCH_SIZE
+    buf = collections.deque()
     while True:
-        if watchdog:
-            watchdog.reset()
-        data = await que.get()
-        if data is None:
+        if deadline:
+            deadline.push()
+        if not buf:
+            buf.append(await que.get())
             que.task_done()
+        while not que.empty():
+            buf.append(que.get_nowait())
+            que.task_done()
+        # Coalesce everything already buffered into one message, up to the
+        # batch cap; record boundaries survive the merge
+        chunks = []
+        size = 0
+        eof = False
+        while buf:
+            data = buf.popleft()
+            if data is None:
+                eof = True
+                break
+            for i in range(0, len(data), M):
+                chunk = data[i:i + M]
+                chunks.append(chunk)
+                size += framing.HDR_SIZE + len(chunk)
+                if size >= B:
+                    rest = data[i + M:]
+                    if len(rest):
+                        buf.appendleft(rest)
+                    break
+            if size >= B:
+                break
+        if chunks:
+            await ws.send(framing.encode(chunks))
+        if eof:
             return
-        for i in range(0, len(data), M):
-            await ws.send(data[i:i + M])
-        que.task_done()
 
 
-async def ws_data_receiver(ws, f_write_to_transport, watchdog):
-    async for data in ws:
-        if watchdog:
-            watchdog.reset()
-        f_write_to_transport(data)
+async def ws_recv(ws, deadline):
+    """One timed receive against the shared idle deadline.
+
+    Returns None on a clean close; a timeout loops back to check() so a
+    deadline pushed by the sender keeps the connection alive.
+    """
+    while True:
+        timeout = deadline.check() if deadline else None
+        try:
+            msg = await asyncio.wait_for(ws.recv(), timeout)
+        except asyncio.TimeoutError:
+            continue
+        except websockets.exceptions.ConnectionClosedOK:
+            return None
+        if deadline:
+            deadline.push()
+        return msg
+
+
+async def ws_data_receiver(ws, f_write_to_transport, deadline):
+    while True:
+        msg = await ws_recv(ws, deadline)
+        if msg is None:
+            return
+        for data in framing.decode(msg):
+            f_write_to_transport(data)
+
+
+async def ws_mux_receiver(ws, que, upstream_addr, idle_timeout, deadline):
+    """Demultiplex records onto per-flow upstream UDP endpoints"""
+    loop = asyncio.get_running_loop()
+    flows = dict()  # flow id -> (transport, flow timer)
+
+    def close_flow(flow_id):
+        flow = flows.pop(flow_id, None)
+        if flow is not None:
+            flow[0].close()
+
+    try:
+        while True:
+            msg = await ws_recv(ws, deadline)
+            if msg is None:
+                return
+            for data in framing.decode(msg):
+                flow_id, payload = framing.strip_flow_id(data)
+                flow = flows.get(flow_id)
+                if flow is None:
+                    if idle_timeout:
+                        timer = wd.DeadlineTimer(idle_timeout,
+                                                 functools.partial(close_flow, flow_id))
+                    else:
+                        timer = None
+                    transport, _ = await loop.create_datagram_endpoint(
+                        lambda: UdpMuxClient(que, upstream_addr, flow_id, timer),
+                        remote_addr=upstream_addr)
+                    flow = flows[flow_id] = (transport, timer)
+                transport, timer = flow
+                if timer:
+                    timer.push()
+                transport.sendto(payload)
+    finally:
+        for transport, timer in list(flows.values()):
+            if timer:
+                timer.cancel()
+            transport.close()
 
 
 def verify_token(expected, received, default):
@@ -90,10 +214,13 @@ def verify_token(expected, received, default):
     return hmac.compare_digest(expected, received)
 
 
-async def ws_server(ws, path, routes, idle_timeout, watchdog_server):
+async def ws_server(ws, path, routes, idle_timeout):
     peer_name = ws.transport.get_extra_info("peername")
+    sock = ws.transport.get_extra_info('socket')
+    if sock is not None:
+        tune_socket(sock)
     path = urlparse(path)
-    logger.debug(f'New Websocket connection from {peer_name}, path={path.path}')
+    logger.debug('New Websocket connection from %s, path=%s', peer_name, path.path)
     try:
         received_token = parse_qs(path.query)['t'][0]
     except Exception:
@@ -101,54 +228,60 @@ async def ws_server(ws, path, routes, idle_timeout, watchdog_server):
     try:
         upstream_proto, upstream_addr, expected_token = routes[path.path]
     except KeyError:
-        logger.info(f'Rejected Websocket connection from {peer_name}: no route')
+        logger.info('Rejected Websocket connection from %s: no route', peer_name)
         return
     try:
         if not verify_token(expected_token, received_token, default=True):
-            logger.info(f'Rejected Websocket connection from {peer_name}: password mismatch')
+            logger.info('Rejected Websocket connection from %s: password mismatch', peer_name)
             return
-        logger.info(f'Accepted Websocket connection from {peer_name}')
+        logger.info('Accepted Websocket connection from %s', peer_name)
         que = asyncio.Queue()
         loop = asyncio.get_running_loop()
         if upstream_proto == 'udp':
-            transport, _ = await loop.create_datagram_endpoint(
-                lambda: UdpClient(que, upstream_addr),
-                remote_addr=upstream_addr)
-            f_write_to_transport = transport.sendto
+            # Flows are created lazily by ws_mux_receiver as records with
+            # new flow ids arrive
+            transport = None
         else:
             transport, _ = await loop.create_connection(
                 lambda: TcpClient(que, upstream_addr),
                 upstream_addr[0], upstream_addr[1])
             f_write_to_transport = transport.write
     except Exception as e:
-        logger.error(repr(e), exc_info=True)
+        logger.error('%r', e, exc_info=True)
         return
     tasks = []
     try:
         if idle_timeout:
-            watchdog = wd.WatchdogClient(watchdog_server,
-                                         idle_timeout,
-                                         wd.IdleTimeout(f"Connection from {peer_name} has idled"))
-            tasks.append(watchdog.start())
+            deadline = wd.Deadline(idle_timeout,
+                                   wd.IdleTimeout(f"Connection from {peer_name} has idled"))
         else:
-            watchdog = None
-        tasks.append(asyncio.create_task(ws_data_receiver(ws, f_write_to_transport, watchdog)))
-        tasks.append(asyncio.create_task(ws_data_sender(ws, que, watchdog)))
-        done, _ = await asyncio.wait(tasks, return_when='FIRST_COMPLETED')
-        for i in done:
-            exc = i.exception()
-            if exc:
-                raise exc
+            deadline = None
+        if upstream_proto == 'udp':
+            tasks.append(asyncio.create_task(
+                ws_mux_receiver(ws, que, upstream_addr, idle_timeout, deadline)))
+        else:
+            tasks.append(asyncio.create_task(ws_data_receiver(ws, f_write_to_transport, deadline)))
+        tasks.append(asyncio.create_task(ws_data_sender(ws, que, deadline)))
+        # Cheaper FIRST_COMPLETED: flip one future from done-callbacks
+        # instead of going through asyncio.wait's machinery
+        stop = asyncio.get_running_loop().create_future()
+        for t in tasks:
+            t.add_done_callback(lambda f, s=stop: s.done() or s.set_result(f))
+        first = await stop
+        exc = first.exception()
+        if exc:
+            raise exc
     except (wd.IdleTimeout,
             websockets.exceptions.ConnectionClosedOK) as e:
-        logger.info(repr(e))
+        logger.info('%r', e)
     except Exception as e:
-        logger.error(repr(e))
+        logger.error('%r', e)
     finally:
         for t in tasks:
             t.cancel()
-        transport.close()
-        logger.debug(f"Connection from {peer_name} is terminated")
+        if transport is not None:
+            transport.close()
+        logger.debug('Connection from %s is terminated', peer_name)
 
 
 Route = namedtuple('Route', ['protocol', 'endpoint', 'token'])
@@ -166,7 +299,7 @@ def parse_routes(routes_json):
         endpoint[1] = int(endpoint[1])
         token = v.get('Token')
         if token is None:
-            logger.warning(f'Path {k} in {routes_json} is not password-protected')
+            logger.warning('Path %s in %s is not password-protected', k, routes_json)
         ret[k] = Route(protocol, tuple(endpoint), token)
     return ret
 
@@ -189,17 +322,18 @@ def main(args):
         ssl_param = dict()
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
-    watchdog_server = wd.WatchdogServer(loop).start()
     ws_server_bound = functools.partial(ws_server,
                                         routes=routes,
-                                        idle_timeout=args.idle_timeout,
-                                        watchdog_server=watchdog_server)
-    loop.run_until_complete(
+                                        idle_timeout=args.idle_timeout)
+    server = loop.run_until_complete(
         websockets.serve(ws_server_bound,
                          local_addr[0], local_addr[1],
                          max_size=constants.WS_MAX_MSG_SIZE_COMP, max_queue=None,
+                         read_limit=args.ws_read_buf, write_limit=args.ws_write_buf,
                          compression='deflate' if args.enable_compress else None,
                          **ssl_param))
+    for sock in server.sockets:
+        tune_socket(sock)
     loop.run_forever()
 
 
@@ -214,36 +348,36 @@ if __name__ == "__main__":
                         help='Server certificate in PEM format with private key')
     parser.add_argument('-c', '--client-ca', type=str, metavar='ca.pem',
                         help='Client CA certificates in PEM format to verify against')
-    parser.add_argument('--enable-compress', type=bool, const=True, nargs='?', help='Compress data before sending')
+    parser.add_argument('--ws-read-buf', type=int, default=2 ** 20, metavar='BYTES',
+                        help='High-water mark of the websocket read buffer')
+    parser.add_argument('--ws-write-buf', type=int, default=2 ** 20, metavar='BYTES',
+                        help='High-water mark of the websocket write buffer')
+    parser.add_argument('--enable-compress', type=bool, const=True, nargs='?',
+                        help='Compress data before sending. Off by default: deflate only burns CPU '
+                             'when the tunneled payload is already encrypted or compressed')
     parser.add_argument('--log-file', type=str, metavar='FILE', help='Log to FILE')
-    parser.add_argument('--log-level', type=str, default="info", choices=['debug', 'info', 'error', 'critical'],
+    parser.add_argument('--log-level', type=str, default="info", choices=LOG_LEVELS,
                         help='Log level')
     args = parser.parse_args()
-    if args.log_level == 'debug':
-        log_level = logging.DEBUG
-    elif args.log_level == 'error':
-        log_level = logging.ERROR
-    elif args.log_level == 'critical':
-        log_level = logging.CRITICAL
-    else:
-        log_level = logging.INFO
+    log_level = LOG_LEVELS[args.log_level]
     logging_config_param = {'format': '%(levelname)s::%(asctime)s::%(filename)s:%(lineno)d::%(message)s',
                             'datefmt': '%Y-%m-%d %H:%M:%S'
                             }
     if args.log_file:
         logging_config_param['filename'] = args.log_file
+    # The log format uses none of these, so skip collecting them per record
+    logging.logMultiprocessing = False
+    logging.logProcesses = False
+    logging.logThreads = False
     logging.basicConfig(**logging_config_param)
     logger.setLevel(log_level)
     wd.logger.setLevel(log_level)
 
-    if sys.platform == 'cygwin':
-        # For windows, with no uvloop support
+    if uvloop is None:
         asyncio.run(main(args))
     elif sys.version_info >= (3, 11):
-        import uvloop
         with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
             runner.run(main(args))
     else:
-        import uvloop
         uvloop.install()
         asyncio.run(main(args))
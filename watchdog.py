@@ -1,56 +1,67 @@
 import asyncio
 import logging
-from functools import partial
 
 logger = logging.getLogger(__name__)
 
 class IdleTimeout(Exception):
     pass
 
-class WatchdogServer():
-    def __init__(self, loop = None):
+class Deadline:
+    """Shared idle deadline for one connection.
+
+    Senders push it forward on activity; receivers enforce it with timed
+    receives, re-checking on every timeout so that outbound-only traffic
+    also keeps the connection alive. No timer or background task needed.
+    """
+    __slots__ = ('loop', 'timeout', 'exc', 'at')
+
+    def __init__(self, timeout, exc, loop = None):
         if loop is None:
-            self.loop = asyncio.get_event_loop()
-        else:
-            self.loop = loop
-        self.clients = set()
-    
-    def start(self):
-        self.loop.call_later(1, self.tick)
-        return self
-    
-    def register(self, client):
-        client.on_timeout.add_done_callback(partial(self.client_timeout, client = client))
-        self.clients.add(client)
-    
-    def client_timeout(self, exc, client):
-        self.clients.discard(client)
-    
-    def tick(self):
-        self.loop.call_later(1, self.tick)
-        for i in self.clients.copy():
-            if i.timeout <= i.cnt:
-                if isinstance(i.result, Exception):
-                    i.on_timeout.set_exception(i.result)
-                else:
-                    i.on_timeout.set_result(i.result)
-            else:
-                i.cnt += 1
-
-class WatchdogClient:
-    def __init__(self, server, timeout, result, loop = None):
-        self.server = server
+            loop = asyncio.get_event_loop()
+        self.loop = loop
         self.timeout = timeout
-        self.result = result
+        self.exc = exc
+        self.at = loop.time() + timeout
+
+    def push(self):
+        self.at = self.loop.time() + self.timeout
+
+    def check(self):
+        """Remaining time before expiry; raises once the deadline passed"""
+        remaining = self.at - self.loop.time()
+        if remaining <= 0:
+            raise self.exc
+        return remaining
+
+class DeadlineTimer:
+    """Deadline enforced by a self-re-arming call_later.
+
+    For flows that have no receive loop of their own; runs f_expire once
+    the pushed deadline actually passes.
+    """
+    __slots__ = ('loop', 'timeout', 'f_expire', 'at', 'handle')
+
+    def __init__(self, timeout, f_expire, loop = None):
         if loop is None:
-            self.on_timeout = asyncio.get_event_loop().create_future()
-        else:
-            self.on_timeout = loop.create_future()
-        self.cnt = 1
-    
-    def start(self):
-        self.server.register(self)
-        return self.on_timeout
-    
-    def reset(self):
-        self.cnt = 1
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.timeout = timeout
+        self.f_expire = f_expire
+        self.at = loop.time() + timeout
+        self.handle = loop.call_later(timeout, self._check_idle)
+
+    def push(self):
+        self.at = self.loop.time() + self.timeout
+
+    def cancel(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def _check_idle(self):
+        remaining = self.at - self.loop.time()
+        if remaining > 0:
+            self.handle = self.loop.call_later(remaining, self._check_idle)
+            return
+        self.handle = None
+        self.f_expire()